@@ -3,7 +3,7 @@
 Telegram Anonymous Bridge Bot
 
 Requirements (Python 3.10+ recommended):
-    pip install python-telegram-bot==21.5 pyyaml filelock
+    pip install python-telegram-bot==21.5 pyyaml orjson
 
 Run:
     export BOT_TOKEN="YOUR_TELEGRAM_BOT_TOKEN"
@@ -15,7 +15,9 @@ What it does:
 - Uses JSON/YAML files for storage (no database):
     - data/config.yaml       – admins, banned patterns, optional default curator
     - data/mappings.json     – student<->curator bindings
-    - data/threads.json      – transient reply-routing (curator msg -> student chat)
+    - data/threads.json      – transient reply-routing (curator msg -> student chat), capped and expired after 7 days
+    - data/threads.log       – append-only journal of new routes, compacted into threads.json
+    - data/seen*             – dbm registry of users who have contacted the bot (first-contact notices)
 - Content safety filter: blocks messages that contain @usernames or phone-like strings
   (patterns configurable in config.yaml). If blocked, notifies admins.
 - Curator replies by replying to the bot's relayed message; bot routes back to the correct student.
@@ -33,6 +35,7 @@ Admin commands:
 - /delpattern <index> – remove banned regex by index (admin only)
 - /patterns – list banned regexes (admin only)
 - /setdefaultcurator <curator_id> – set fallback curator (admin only)
+- /reload – re-read config.yaml and mappings.json after manual edits (admin only; also on SIGHUP)
 
 File formats:
 - config.yaml example is generated on first run if missing.
@@ -40,36 +43,47 @@ File formats:
 
 """
 from __future__ import annotations
-import json
+import asyncio
+import copy
+import dbm
 import logging
 import os
 import re
+import signal
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Dict, Optional, Any, List, Tuple
 
-from filelock import FileLock
 from telegram import (
     Update,
     Message,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
 )
-from telegram.constants import ChatType, ParseMode
+from telegram.constants import ParseMode
 from telegram.ext import (
     Application,
     ApplicationBuilder,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    ConversationHandler,
     filters,
     ContextTypes,
 )
 
+import orjson
 import yaml
 from dotenv import load_dotenv
 
+try:
+    # libyaml C extension, ~10x faster than the pure-Python implementation
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 # Load .env if present
 load_dotenv()
 
@@ -83,14 +97,24 @@ DATA_DIR.mkdir(exist_ok=True)
 CONFIG_YAML = DATA_DIR / "config.yaml"
 MAPPINGS_JSON = DATA_DIR / "mappings.json"
 THREADS_JSON = DATA_DIR / "threads.json"
+THREADS_LOG = DATA_DIR / "threads.log"  # append-only journal of routes, folded into threads.json on compaction
+THREADS_LOG_OLD = DATA_DIR / "threads.log.old"  # journal being compacted; removed once the snapshot is written
+
+THREADS_COMPACT_EVERY = 500  # appends
+THREADS_COMPACT_INTERVAL = 60  # seconds
+ROUTES_FLUSH_DELAY = 0.05  # seconds; journal lines are group-committed at most this late
+ROUTES_FLUSH_MAX = 64  # ...or as soon as this many are buffered
+ROUTES_MAX = 10_000  # oldest routes are evicted beyond this
+ROUTES_TTL = 7 * 24 * 3600  # seconds; older routes are dropped on compaction
 
-CONFIG_LOCK = FileLock(str(CONFIG_YAML) + ".lock")
-MAPPINGS_LOCK = FileLock(str(MAPPINGS_JSON) + ".lock")
-THREADS_LOCK = FileLock(str(THREADS_JSON) + ".lock")
+# Single bot process owns the data files, so in-process asyncio locks are enough.
+CONFIG_LOCK = asyncio.Lock()
+MAPPINGS_LOCK = asyncio.Lock()
+THREADS_LOCK = asyncio.Lock()
 
 # Blocked events storage
 BLOCKED_JSON = DATA_DIR / "blocked.json"
-BLOCKED_LOCK = FileLock(str(BLOCKED_JSON) + ".lock")
+BLOCKED_LOCK = asyncio.Lock()
 
 DEFAULT_CONFIG = {
     "admins": [],  # Telegram user IDs allowed to use admin commands
@@ -104,50 +128,120 @@ DEFAULT_CONFIG = {
     },
 }
 
+# In-memory caches: the bot owns its data files, so they are parsed once and re-read only
+# after request_reload() (SIGHUP or /reload) — no stat on the hot path.
+# Mutations go through save_yaml/save_json, which write the cached object back to disk.
+# Threads are owned by this process only (snapshot + journal), so they are never re-read.
+_CFG: Optional[dict] = None
+_CFG_STALE = False
+_MAP: Optional[dict] = None
+_MAP_STALE = False
+# Reverse indices over _MAP["students"], kept in sync by set_mapping/del_mapping
+_BY_TICKET: Dict[str, int] = {}
+# curator -> students as an ordered set (dict with None values) so /mystudents keeps binding order
+_BY_CURATOR: Dict[int, Dict[int, None]] = {}
+# Derived from _CFG["admins"], rebuilt by on_config_loaded
+_ADMIN_SET: frozenset = frozenset()
+_THR: Optional[dict] = None
+_THR_LOG_FH = None
+_THR_APPENDS = 0
+_ROUTE_BUF: List[bytes] = []  # journal lines not yet written
+_ROUTE_FLUSH: Optional[asyncio.TimerHandle] = None
+_THR_COMPACT = asyncio.Event()  # wakes threads_compactor early after THREADS_COMPACT_EVERY appends
+
+
+def request_reload() -> None:
+    """Mark config and mappings for re-reading on next access."""
+    global _CFG_STALE, _MAP_STALE
+    _CFG_STALE = _MAP_STALE = True
+
+
+# Disk I/O runs in a worker thread so the event loop keeps serving updates;
+# (de)serialization stays on the loop so data is not mutated mid-dump.
+async def _read_text(path: Path) -> Optional[str]:
+    try:
+        return await asyncio.to_thread(path.read_text, encoding="utf-8")
+    except FileNotFoundError:
+        return None
+
+
+async def _write_text(path: Path, text: str) -> None:
+    await asyncio.to_thread(path.write_text, text, encoding="utf-8")
+
+
+async def _read_bytes(path: Path) -> Optional[bytes]:
+    try:
+        return await asyncio.to_thread(path.read_bytes)
+    except FileNotFoundError:
+        return None
+
+
+async def _write_bytes(path: Path, data: bytes) -> None:
+    await asyncio.to_thread(path.write_bytes, data)
+
+
+def _dumps(data: Any) -> bytes:
+    """Pretty JSON as UTF-8 bytes (orjson never escapes non-ASCII)."""
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+
 
-def load_yaml(path: Path, default: dict) -> dict:
-    with CONFIG_LOCK:
-        if not path.exists():
-            path.write_text(yaml.safe_dump(default, allow_unicode=True), encoding="utf-8")
-            return default.copy()
-        return yaml.safe_load(path.read_text(encoding="utf-8")) or default.copy()
+async def load_yaml(path: Path, default: dict) -> dict:
+    async with CONFIG_LOCK:
+        txt = await _read_text(path)
+        if txt is None:
+            await _write_text(path, yaml.dump(default, Dumper=SafeDumper, allow_unicode=True))
+            return copy.deepcopy(default)
+        return yaml.load(txt, Loader=SafeLoader) or copy.deepcopy(default)
 
 
-def save_yaml(path: Path, data: dict) -> None:
-    with CONFIG_LOCK:
-        path.write_text(yaml.safe_dump(data, allow_unicode=True), encoding="utf-8")
+async def save_yaml(path: Path, data: dict) -> None:
+    global _CFG
+    txt = yaml.dump(data, Dumper=SafeDumper, allow_unicode=True)
+    async with CONFIG_LOCK:
+        await _write_text(path, txt)
+        if path == CONFIG_YAML:
+            _CFG = data
+            on_config_loaded(data)
 
 
-def load_json(path: Path, default: dict) -> dict:
+async def load_json(path: Path, default: dict) -> dict:
     lock = MAPPINGS_LOCK if path == MAPPINGS_JSON else THREADS_LOCK
-    with lock:
-        if not path.exists():
-            path.write_text(json.dumps(default, ensure_ascii=False, indent=2), encoding="utf-8")
-            return json.loads(json.dumps(default))
-        return json.loads(path.read_text(encoding="utf-8"))
+    async with lock:
+        raw = await _read_bytes(path)
+        if raw is None:
+            raw = _dumps(default)
+            await _write_bytes(path, raw)
+        return orjson.loads(raw)
 
 
-def save_json(path: Path, data: dict) -> None:
+async def save_json(path: Path, data: dict) -> None:
+    global _MAP, _THR
     lock = MAPPINGS_LOCK if path == MAPPINGS_JSON else THREADS_LOCK
-    with lock:
-        path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    raw = _dumps(data)
+    async with lock:
+        await _write_bytes(path, raw)
+        if path == MAPPINGS_JSON:
+            if data is not _MAP:
+                index_mappings(data)
+            _MAP = data
+        elif path == THREADS_JSON:
+            _THR = data
 
 
-def load_blocked() -> dict:
-    with BLOCKED_LOCK:
-        if not BLOCKED_JSON.exists():
-            BLOCKED_JSON.write_text(json.dumps({"blocked": []}, ensure_ascii=False, indent=2), encoding="utf-8")
-            return {"blocked": []}
-        return json.loads(BLOCKED_JSON.read_text(encoding="utf-8"))
+async def load_blocked() -> dict:
+    raw = await _read_bytes(BLOCKED_JSON)
+    if raw is None:
+        await _write_bytes(BLOCKED_JSON, _dumps({"blocked": []}))
+        return {"blocked": []}
+    return orjson.loads(raw)
 
 
-def save_blocked(data: dict) -> None:
-    with BLOCKED_LOCK:
-        BLOCKED_JSON.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+async def save_blocked(data: dict) -> None:
+    await _write_bytes(BLOCKED_JSON, _dumps(data))
 
 
-def record_blocked_event(sender_id: int, sender_username: Optional[str], direction: str, target: Optional[int], target_ticket: Optional[str], text: Optional[str], reason: str) -> None:
-    """Append a blocked event to data/blocked.json (thread-safe).
+async def record_blocked_event(sender_id: int, sender_username: Optional[str], direction: str, target: Optional[int], target_ticket: Optional[str], text: Optional[str], reason: str) -> None:
+    """Append a blocked event to data/blocked.json (serialized by BLOCKED_LOCK).
 
     Fields: ts, sender_id, sender_username, direction, target, target_ticket, text_preview, reason
     """
@@ -161,43 +255,57 @@ def record_blocked_event(sender_id: int, sender_username: Optional[str], directi
         "text_preview": (text[:500] + "...") if text and len(text) > 500 else (text or ""),
         "reason": reason,
     }
-    data = load_blocked()
-    data.setdefault("blocked", []).append(ev)
-    save_blocked(data)
+    async with BLOCKED_LOCK:
+        data = await load_blocked()
+        data.setdefault("blocked", []).append(ev)
+        await save_blocked(data)
 
 
 # --------------------------- Seen Users (first-contact registry) ---------------------------
-SEEN_JSON = DATA_DIR / "seen_users.json"
-SEEN_LOCK = FileLock(str(SEEN_JSON) + ".lock")
-
-def load_seen() -> dict:
-    with SEEN_LOCK:
-        if not SEEN_JSON.exists():
-            SEEN_JSON.write_text(json.dumps({"users": {}}, ensure_ascii=False, indent=2), encoding="utf-8")
-            return {"users": {}}
-        return json.loads(SEEN_JSON.read_text(encoding="utf-8"))
-
-def save_seen(data: dict) -> None:
-    with SEEN_LOCK:
-        SEEN_JSON.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-
-def mark_user_seen(user) -> bool:
+# Key-value store (dbm picks the backend: gnu/ndbm/dumb) keyed by str(user_id), value is JSON.
+# Lookups and inserts touch a single record instead of rewriting the whole registry.
+SEEN_DB = DATA_DIR / "seen"
+SEEN_JSON = DATA_DIR / "seen_users.json"  # legacy registry, imported once into SEEN_DB
+SEEN_LOCK = asyncio.Lock()
+_SEEN = None
+
+def _open_seen_db():
+    db = dbm.open(str(SEEN_DB), "c")
+    if len(db) == 0 and SEEN_JSON.exists():
+        for uid, info in orjson.loads(SEEN_JSON.read_bytes()).get("users", {}).items():
+            db[uid] = orjson.dumps(info)
+    return db
+
+async def get_seen_db():
+    global _SEEN
+    if _SEEN is None:
+        _SEEN = await asyncio.to_thread(_open_seen_db)
+    return _SEEN
+
+def close_seen_db() -> None:
+    global _SEEN
+    if _SEEN is not None:
+        _SEEN.close()
+        _SEEN = None
+
+async def mark_user_seen(user) -> bool:
     """
     Record a user the first time they interact with the bot.
     Returns True if newly seen; False if already present.
     """
-    seen = load_seen()
-    uid = str(user.id)
-    if uid in seen.get("users", {}):
-        return False
-    seen.setdefault("users", {})[uid] = {
-        "id": user.id,
-        "username": user.username,
-        "first_name": user.first_name,
-        "last_name": user.last_name,
-        "ts": int(time.time()),
-    }
-    save_seen(seen)
+    async with SEEN_LOCK:
+        db = await get_seen_db()
+        uid = str(user.id)
+        if uid in db:
+            return False
+        info = {
+            "id": user.id,
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "ts": int(time.time()),
+        }
+        await asyncio.to_thread(db.__setitem__, uid, orjson.dumps(info))
     return True
 
 # --------------------------- Domain Model ---------------------------
@@ -210,128 +318,364 @@ class Binding:
 
 # --------------------------- Mappings & Threads ---------------------------
 
-def ensure_files() -> None:
-    load_yaml(CONFIG_YAML, DEFAULT_CONFIG)
-    load_json(MAPPINGS_JSON, {"students": {}, "curators": {}})
-    load_json(THREADS_JSON, {"routes": {}, "ts": int(time.time())})
-
-
-def get_config() -> dict:
-    return load_yaml(CONFIG_YAML, DEFAULT_CONFIG)
-
+async def ensure_files() -> None:
+    await get_config()
+    await get_mappings()
+    await get_threads()
+    await get_seen_db()
+
+
+async def get_config() -> dict:
+    """Return the cached config, re-reading config.yaml only after request_reload()."""
+    global _CFG, _CFG_STALE
+    if _CFG is None or _CFG_STALE:
+        _CFG_STALE = False
+        _CFG = await load_yaml(CONFIG_YAML, DEFAULT_CONFIG)
+        on_config_loaded(_CFG)
+    return _CFG
+
+
+def on_config_loaded(cfg: dict) -> None:
+    """Rebuild everything derived from the config after it is (re)loaded or saved."""
+    global _ADMIN_SET
+    _ADMIN_SET = frozenset(cfg.get("admins") or [])
+    compile_banned_regex(cfg)
+
+
+async def get_mappings() -> dict:
+    global _MAP, _MAP_STALE
+    if _MAP is None or _MAP_STALE:
+        _MAP_STALE = False
+        mappings = await load_json(MAPPINGS_JSON, {"students": {}, "curators": {}})
+        # JSON object keys are strings; in memory everything is keyed by int chat id
+        # (orjson writes them back as strings via OPT_NON_STR_KEYS).
+        _MAP = {
+            **mappings,
+            "students": {int(k): v for k, v in mappings.get("students", {}).items()},
+            "curators": {int(k): v for k, v in mappings.get("curators", {}).items()},
+        }
+        index_mappings(_MAP)
+    return _MAP
+
+
+def index_mappings(mappings: dict) -> None:
+    """Rebuild ticket -> student and curator -> students indices from scratch."""
+    _BY_TICKET.clear()
+    _BY_CURATOR.clear()
+    for sid, payload in mappings.get("students", {}).items():
+        _index_add(sid, payload)
+
+
+def _index_add(student_id: int, payload: dict) -> None:
+    # Tickets are not unique (prefix + last 4 digits); the first binding keeps it, as before
+    _BY_TICKET.setdefault(payload.get("ticket"), student_id)
+    _BY_CURATOR.setdefault(int(payload.get("curator")), {})[student_id] = None
+
+
+def _index_remove(student_id: int, payload: dict, students: dict) -> None:
+    ticket = payload.get("ticket")
+    if _BY_TICKET.get(ticket) == student_id:
+        del _BY_TICKET[ticket]
+        # Hand the ticket over to another student sharing it, if any
+        for sid, other in students.items():
+            if other.get("ticket") == ticket and sid != student_id:
+                _BY_TICKET[ticket] = sid
+                break
+    _BY_CURATOR.get(int(payload.get("curator")), {}).pop(student_id, None)
+
+
+async def get_threads() -> dict:
+    """Return the in-memory routes: threads.json snapshot with the journal(s) replayed on top."""
+    global _THR
+    if _THR is None:
+        threads = await load_json(THREADS_JSON, {"routes": {}, "ts": int(time.time())})
+        # Oldest first, so both the size cap and the TTL evict from the front
+        routes: OrderedDict = OrderedDict()
+        for key, entry in threads.get("routes", {}).items():
+            if not isinstance(entry, dict):
+                # Legacy format: bare student_id without a timestamp
+                entry = {"s": entry, "ts": threads.get("ts", 0)}
+            _route_put(routes, key, entry)
+        # threads.log.old is left behind only if a compaction did not finish
+        journal = (await _read_bytes(THREADS_LOG_OLD) or b"") + (await _read_bytes(THREADS_LOG) or b"")
+        for line in journal.splitlines():
+            try:
+                rec = orjson.loads(line)
+            except ValueError:
+                # Torn last line after a crash
+                continue
+            _route_put(routes, rec["k"], {"s": rec["s"], "ts": rec["ts"]})
+            threads["ts"] = rec["ts"]
+        threads["routes"] = routes
+        _THR = threads
+    return _THR
+
+
+def _route_put(routes: OrderedDict, key: str, entry: dict) -> None:
+    routes[key] = entry
+    routes.move_to_end(key)
+    if len(routes) > ROUTES_MAX:
+        routes.popitem(last=False)
+
+
+def _routes_expire(routes: OrderedDict) -> None:
+    cutoff = int(time.time()) - ROUTES_TTL
+    while routes and next(iter(routes.values()))["ts"] < cutoff:
+        routes.popitem(last=False)
+
+
+def _rotate_journal() -> None:
+    """Move everything journaled so far to threads.log.old; new appends start a fresh threads.log."""
+    global _THR_LOG_FH
+    flush_routes()
+    if _THR_LOG_FH is not None:
+        _THR_LOG_FH.close()
+        _THR_LOG_FH = None
+    if not THREADS_LOG.exists():
+        return
+    if THREADS_LOG_OLD.exists():
+        # A previous compaction failed before its snapshot landed: keep both journals
+        with open(THREADS_LOG_OLD, "ab") as fh:
+            fh.write(THREADS_LOG.read_bytes())
+        THREADS_LOG.unlink()
+    else:
+        os.replace(THREADS_LOG, THREADS_LOG_OLD)
 
-def get_mappings() -> dict:
-    return load_json(MAPPINGS_JSON, {"students": {}, "curators": {}})
 
+async def compact_threads() -> None:
+    """Rewrite threads.json from memory and drop the journal it now covers.
 
-def get_threads() -> dict:
-    return load_json(THREADS_JSON, {"routes": {}, "ts": int(time.time())})
+    The journal is rotated first, so routes appended while the snapshot is being
+    written go to a fresh threads.log and are not lost or rewritten.
+    """
+    global _THR_APPENDS
+    threads = await get_threads()
+    async with THREADS_LOCK:
+        pending = _THR_APPENDS
+        _rotate_journal()
+        _routes_expire(threads["routes"])
+        raw = _dumps(threads)
+        await _write_bytes(THREADS_JSON, raw)
+        THREADS_LOG_OLD.unlink(missing_ok=True)
+        _THR_APPENDS -= pending
+
+
+async def threads_compactor() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_THR_COMPACT.wait(), THREADS_COMPACT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _THR_COMPACT.clear()
+        if _THR_APPENDS:
+            try:
+                await compact_threads()
+            except Exception:
+                # Keep the task alive; the journal still holds the routes. Back off instead of
+                # retrying on every wake-up while e.g. the disk is full.
+                logger.exception("threads.json compaction failed")
+                await asyncio.sleep(THREADS_COMPACT_INTERVAL)
 
 
-def set_mapping(student_id: int, curator_id: int, ticket: Optional[str] = None) -> Binding:
-    cfg = get_config()
-    mappings = get_mappings()
+async def set_mapping(student_id: int, curator_id: int, ticket: Optional[str] = None) -> Binding:
+    cfg = await get_config()
+    mappings = await get_mappings()
 
     if not ticket:
         prefix = cfg.get("branding", {}).get("student_tag_prefix", "S")
         ticket = f"{prefix}{str(student_id)[-4:]}"  # e.g., S1234
 
-    mappings.setdefault("students", {})[str(student_id)] = {
+    students = mappings.setdefault("students", {})
+    old = students.get(student_id)
+    # Re-linking to the same curator and ticket keeps the student's place in the indices
+    unchanged = bool(old) and int(old.get("curator", 0)) == curator_id and old.get("ticket") == ticket
+    if old and not unchanged:
+        _index_remove(student_id, old, students)
+    students[student_id] = {
         "curator": curator_id,
         "ticket": ticket,
     }
-    cur_list = mappings.setdefault("curators", {}).setdefault(str(curator_id), [])
+    if not unchanged:
+        _index_add(student_id, students[student_id])
+    cur_list = mappings.setdefault("curators", {}).setdefault(curator_id, [])
     if student_id not in cur_list:
         cur_list.append(student_id)
 
-    save_json(MAPPINGS_JSON, mappings)
+    await save_json(MAPPINGS_JSON, mappings)
     return Binding(student_id=student_id, curator_id=curator_id, ticket=ticket)
 
 
-def del_mapping(student_id: int) -> bool:
-    mappings = get_mappings()
-    s = mappings.get("students", {}).pop(str(student_id), None)
+async def del_mapping(student_id: int) -> bool:
+    mappings = await get_mappings()
+    s = mappings.get("students", {}).pop(student_id, None)
     if s:
+        _index_remove(student_id, s, mappings["students"])
         cur_id = s.get("curator")
-        cur_list = mappings.setdefault("curators", {}).get(str(cur_id), [])
-        mappings.setdefault("curators", {})[str(cur_id)] = [x for x in cur_list if x != student_id]
-        save_json(MAPPINGS_JSON, mappings)
+        cur_list = mappings.setdefault("curators", {}).get(cur_id, [])
+        mappings.setdefault("curators", {})[cur_id] = [x for x in cur_list if x != student_id]
+        await save_json(MAPPINGS_JSON, mappings)
         return True
     return False
 
 
-def find_binding(student_id: int) -> Optional[Binding]:
-    mappings = get_mappings()
-    s = mappings.get("students", {}).get(str(student_id))
+async def find_binding(student_id: int) -> Optional[Binding]:
+    mappings = await get_mappings()
+    s = mappings.get("students", {}).get(student_id)
     if not s:
         return None
     return Binding(student_id=student_id, curator_id=s["curator"], ticket=s["ticket"]) 
 
 
-def list_bindings() -> List[Binding]:
-    mappings = get_mappings()
+async def list_bindings() -> List[Binding]:
+    mappings = await get_mappings()
     out: List[Binding] = []
     for sid, payload in mappings.get("students", {}).items():
-        out.append(Binding(student_id=int(sid), curator_id=int(payload["curator"]), ticket=payload["ticket"]))
+        out.append(Binding(student_id=sid, curator_id=int(payload["curator"]), ticket=payload["ticket"]))
     return out
 
 
-def student_by_ticket(ticket: str) -> Optional[int]:
+async def student_by_ticket(ticket: str) -> Optional[int]:
     """Return student_id by anonymized ticket like 'S1234'."""
-    mappings = get_mappings()
-    for sid, payload in mappings.get("students", {}).items():
-        if payload.get("ticket") == ticket:
-            return int(sid)
-    return None
+    await get_mappings()
+    return _BY_TICKET.get(ticket)
 
 
-def list_students_for_curator(curator_id: int) -> List[Binding]:
+async def list_students_for_curator(curator_id: int) -> List[Binding]:
     """Return bindings for all students assigned to a curator."""
-    mappings = get_mappings()
+    mappings = await get_mappings()
+    students = mappings.get("students", {})
     res: List[Binding] = []
-    for sid, payload in mappings.get("students", {}).items():
-        if int(payload.get("curator")) == int(curator_id):
-            res.append(Binding(student_id=int(sid), curator_id=int(curator_id), ticket=payload.get("ticket")))
+    for sid in _BY_CURATOR.get(int(curator_id), ()):
+        res.append(Binding(student_id=sid, curator_id=int(curator_id), ticket=students[sid].get("ticket")))
     return res
 
 
-def route_remember(curator_msg_id: int, curator_chat_id: int, student_id: int) -> None:
-    threads = get_threads()
+def flush_routes() -> None:
+    """Write all buffered journal lines with a single write() (group commit)."""
+    global _THR_LOG_FH, _ROUTE_FLUSH
+    if _ROUTE_FLUSH is not None:
+        _ROUTE_FLUSH.cancel()
+        _ROUTE_FLUSH = None
+    if not _ROUTE_BUF:
+        return
+    # A single short append; not worth a thread hop. The buffered handle's flush() retries
+    # short writes, so a batch never leaves a torn line behind.
+    if _THR_LOG_FH is None:
+        _THR_LOG_FH = open(THREADS_LOG, "ab")
+    _THR_LOG_FH.write(b"".join(_ROUTE_BUF))
+    _THR_LOG_FH.flush()
+    _ROUTE_BUF.clear()
+
+
+async def route_remember(curator_msg_id: int, curator_chat_id: int, student_id: int) -> None:
+    global _THR_APPENDS, _ROUTE_FLUSH
+    threads = await get_threads()
     key = f"{curator_chat_id}:{curator_msg_id}"
-    threads.setdefault("routes", {})[key] = student_id
-    threads["ts"] = int(time.time())
-    save_json(THREADS_JSON, threads)
+    ts = int(time.time())
+    _route_put(threads["routes"], key, {"s": student_id, "ts": ts})
+    threads["ts"] = ts
+    # The live dict is updated right away; the journal line is batched with its neighbours.
+    _ROUTE_BUF.append(orjson.dumps({"k": key, "s": student_id, "ts": ts}) + b"\n")
+    _THR_APPENDS += 1
+    if len(_ROUTE_BUF) >= ROUTES_FLUSH_MAX:
+        try:
+            flush_routes()
+        except OSError:
+            # The message is already relayed; keep the route buffered and retry on the next flush
+            logger.exception("threads.log append failed")
+    elif _ROUTE_FLUSH is None:
+        _ROUTE_FLUSH = asyncio.get_running_loop().call_later(ROUTES_FLUSH_DELAY, flush_routes)
+    if _THR_APPENDS >= THREADS_COMPACT_EVERY:
+        # Compaction rewrites the whole snapshot; leave it to the background task
+        _THR_COMPACT.set()
 
 
 def route_lookup(curator_msg: Message) -> Optional[int]:
+    """Resolve the student behind the bot message a curator replied to.
+
+    Routes are loaded by ensure_files() at startup and live only in memory after that.
+    """
     if not curator_msg.reply_to_message:
         return None
     key = f"{curator_msg.chat_id}:{curator_msg.reply_to_message.message_id}"
-    threads = get_threads()
-    return threads.get("routes", {}).get(key)
+    entry = _THR["routes"].get(key)
+    return entry["s"] if entry else None
 
 
 # --------------------------- Filters ---------------------------
 
-def violates_policies(text: str, cfg: dict) -> Optional[str]:
-    if not text:
-        return None
-    for idx, pattern in enumerate(cfg.get("banned_regex", [])):
+# banned_regex entries are folded into one alternation where possible; group "_b<idx>" marks
+# which one matched. Patterns the alternation cannot represent as-is (capture groups, whose
+# numbered backreferences would shift, or inline global flags) are searched separately.
+# Rebuilt by on_config_loaded.
+_BANNED_RE: Optional[re.Pattern] = None
+_BANNED_SEPARATE: List[re.Pattern] = []
+_BANNED_COMPILED: List[Optional[re.Pattern]] = []  # per index; None for invalid patterns
+_BANNED_SRC: List[str] = []
+_PLAIN_FLAGS = re.compile("", re.IGNORECASE).flags
+_GLOBAL_FLAGS_RE = re.compile(r"\(\?[aiLmsux]+\)")  # leading "(?i)" etc., invalid mid-alternation
+
+
+def build_banned_regex(patterns: List[str]) -> Tuple[Optional[re.Pattern], List[re.Pattern], List[Optional[re.Pattern]]]:
+    """Compile banned_regex into (alternation, separately searched patterns, per-index patterns)."""
+    parts: List[str] = []
+    plain: List[re.Pattern] = []
+    separate: List[re.Pattern] = []
+    compiled: List[Optional[re.Pattern]] = []
+    for idx, pattern in enumerate(patterns):
         try:
-            if re.search(pattern, text, flags=re.IGNORECASE):
-                return f"Matched banned_regex[{idx}]: {pattern}"
+            rx = re.compile(pattern, re.IGNORECASE)
         except re.error:
-            # Ignore bad patterns
+            compiled.append(None)
             continue
+        compiled.append(rx)
+        if rx.groups == 0 and rx.flags == _PLAIN_FLAGS and not _GLOBAL_FLAGS_RE.match(pattern):
+            parts.append(f"(?P<_b{idx}>{pattern})")
+            plain.append(rx)
+        else:
+            separate.append(rx)
+    combined = None
+    if parts:
+        # Compiled once; should the joined alternation still be rejected, search them separately
+        try:
+            combined = re.compile("|".join(parts), re.IGNORECASE)
+        except re.error:
+            separate = plain + separate
+    return combined, separate, compiled
+
+
+def compile_banned_regex(cfg: dict) -> None:
+    global _BANNED_RE, _BANNED_SEPARATE, _BANNED_COMPILED, _BANNED_SRC
+    patterns = list(cfg.get("banned_regex", []))
+    _BANNED_RE, _BANNED_SEPARATE, _BANNED_COMPILED = build_banned_regex(patterns)
+    _BANNED_SRC = patterns
+    for idx, rx in enumerate(_BANNED_COMPILED):
+        if rx is None:
+            # /setpattern validates input; this only catches hand edits of config.yaml
+            logger.warning("Skipping invalid banned_regex[%d]: %r", idx, patterns[idx])
+
+
+def violates_policies(text: str) -> Optional[str]:
+    if not text:
+        return None
+    hit = _BANNED_RE is not None and _BANNED_RE.search(text)
+    if not hit:
+        hit = any(rx.search(text) for rx in _BANNED_SEPARATE)
+    if not hit:
+        return None
+    # Blocked (rare) path: report the first pattern in list order that matches, as before
+    for idx, rx in enumerate(_BANNED_COMPILED):
+        if rx is not None and rx.search(text):
+            return f"Matched banned_regex[{idx}]: {_BANNED_SRC[idx]}"
     return None
 
 
 async def notify_admins(app: Application, cfg: dict, message: str) -> None:
-    for admin_id in cfg.get("admins", []):
-        try:
-            await app.bot.send_message(admin_id, message)
-        except Exception:
-            pass
+    # Fan out concurrently; a failed send to one admin must not affect the others
+    await asyncio.gather(
+        *(app.bot.send_message(admin_id, message) for admin_id in cfg.get("admins", [])),
+        return_exceptions=True,
+    )
 
 
 # --------------------------- Utilities ---------------------------
@@ -340,20 +684,11 @@ async def notify_admins(app: Application, cfg: dict, message: str) -> None:
 # use the `is_media_copyable_message` helper which checks the Message object.
 MEDIA_COPYABLE = None
 
+_MEDIA_ATTRS = ("photo", "video", "video_note", "voice", "audio", "document", "sticker")
+
 # Filters from PTB expect Update, not Message. We'll use a helper for Message objects.
 def is_media_copyable_message(msg: Message) -> bool:
-    try:
-        return bool(
-            getattr(msg, "photo", None) or
-            getattr(msg, "video", None) or
-            getattr(msg, "video_note", None) or
-            getattr(msg, "voice", None) or
-            getattr(msg, "audio", None) or
-            getattr(msg, "document", None) or
-            getattr(msg, "sticker", None)
-        )
-    except Exception:
-        return False
+    return any(getattr(msg, a, None) for a in _MEDIA_ATTRS)
 
 
 def caption_of(msg: Message) -> Optional[str]:
@@ -380,9 +715,9 @@ async def copy_message_safely(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     # Mark user as seen; if it's the first time, notify ONLY admins (silent for user)
-    is_new = mark_user_seen(user)
+    is_new = await mark_user_seen(user)
     if is_new:
-        cfg = get_config()
+        cfg = await get_config()
         info = f"NEW USER: id={user.id}"
         if user.username:
             info += f", username=@{user.username}"
@@ -398,13 +733,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    cfg = get_config()
+    cfg = await get_config()
     user_id = update.effective_user.id
     admins = cfg.get("admins", [])
-    mappings = get_mappings()
-    is_curator = str(user_id) in mappings.get("curators", {})
+    mappings = await get_mappings()
+    is_curator = user_id in mappings.get("curators", {})
 
-    if is_admin(user_id):
+    if await is_admin(user_id):
         text = [
             "Админская справка:\n",
             "— Управление связями ученик↔куратор:",
@@ -418,6 +753,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             "/delpattern <index>",
             "",
             "/setdefaultcurator <curator_id>",
+            "/reload — перечитать config.yaml и mappings.json",
             "",
             f"Admins: {admins if admins else 'нет'}",
         ]
@@ -444,13 +780,13 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text("\n".join(text))
 
 
-def is_admin(user_id: int) -> bool:
-    cfg = get_config()
-    return user_id in cfg.get("admins", [])
+async def is_admin(user_id: int) -> bool:
+    await get_config()
+    return user_id in _ADMIN_SET
 
 
 async def link_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     try:
         student_id = int(context.args[0])
@@ -458,116 +794,143 @@ async def link_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     except Exception:
         await update.message.reply_text("Использование: /link <student_id> <curator_id>")
         return
-    b = set_mapping(student_id, curator_id)
+    b = await set_mapping(student_id, curator_id)
     await update.message.reply_text(f"Связал {b.ticket} ({b.student_id}) → куратор {b.curator_id}")
 
 
 async def unlink_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     try:
         student_id = int(context.args[0])
     except Exception:
         await update.message.reply_text("Использование: /unlink <student_id>")
         return
-    ok = del_mapping(student_id)
+    ok = await del_mapping(student_id)
     await update.message.reply_text("Удалено" if ok else "Не найдено")
 
 
 async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
-    rows = [f"{b.ticket}: {b.student_id} → {b.curator_id}" for b in list_bindings()]
+    rows = [f"{b.ticket}: {b.student_id} → {b.curator_id}" for b in await list_bindings()]
     await update.message.reply_text("\n".join(rows) if rows else "Пусто")
 
 
 async def patterns_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
-    cfg = get_config()
+    cfg = await get_config()
     rows = [f"[{i}] {p}" for i, p in enumerate(cfg.get("banned_regex", []))]
     await update.message.reply_text("\n".join(rows) if rows else "Список пуст")
 
 
 async def setpattern_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     pattern = " ".join(context.args).strip()
     if not pattern:
         await update.message.reply_text("Использование: /setpattern <regex>")
         return
-    cfg = get_config()
+    try:
+        re.compile(pattern, re.IGNORECASE)
+    except re.error:
+        await update.message.reply_text("Некорректный regex")
+        return
+    cfg = await get_config()
     cfg.setdefault("banned_regex", []).append(pattern)
-    save_yaml(CONFIG_YAML, cfg)
+    await save_yaml(CONFIG_YAML, cfg)
     await update.message.reply_text(f"Добавлен паттерн: {pattern}")
 
 
 async def delpattern_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     try:
         idx = int(context.args[0])
     except Exception:
         await update.message.reply_text("Использование: /delpattern <index>")
         return
-    cfg = get_config()
+    cfg = await get_config()
     arr = cfg.get("banned_regex", [])
     if 0 <= idx < len(arr):
         removed = arr.pop(idx)
-        save_yaml(CONFIG_YAML, cfg)
+        await save_yaml(CONFIG_YAML, cfg)
         await update.message.reply_text(f"Удален паттерн: {removed}")
     else:
         await update.message.reply_text("Нет такого индекса")
 
 
 async def setdefaultcurator_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not is_admin(update.effective_user.id):
+    if not await is_admin(update.effective_user.id):
         return
     try:
         curator_id = int(context.args[0])
     except Exception:
         await update.message.reply_text("Использование: /setdefaultcurator <curator_id>")
         return
-    cfg = get_config()
+    cfg = await get_config()
     cfg["default_curator"] = curator_id
-    save_yaml(CONFIG_YAML, cfg)
+    await save_yaml(CONFIG_YAML, cfg)
     await update.message.reply_text(f"default_curator = {curator_id}")
 
 
+async def reload_data() -> None:
+    """Re-read config and mappings now, so direct cache readers (IS_CURATOR) never see them stale."""
+    request_reload()
+    await get_config()
+    await get_mappings()
+
+
+async def reload_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Re-read config.yaml and mappings.json after manual edits (same as SIGHUP)."""
+    if not await is_admin(update.effective_user.id):
+        return
+    await reload_data()
+    await update.message.reply_text("Конфиг и привязки перечитаны")
+
+
 # --------------------------- Core Flow ---------------------------
-async def to_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Direct send from curator: /to <student_id|ticket> [text]"""
+# Состояние диалога двухшагового /to
+AWAITING_TO = 0
+
+
+async def to_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Direct send from curator: /to <student_id|ticket> [text]
+
+    Without text, enters AWAITING_TO and the next message goes to the student (see to_followup).
+    """
     user_id = update.effective_user.id
-    mappings = get_mappings()
-    is_curator = str(user_id) in mappings.get("curators", {}) or is_admin(user_id)
+    mappings = await get_mappings()
+    is_curator = user_id in mappings.get("curators", {}) or await is_admin(user_id)
     if not is_curator:
-        return
+        return ConversationHandler.END
 
     if not context.args:
         await update.message.reply_text("Использование: /to <student_id|ticket> [текст]")
-        return
+        return ConversationHandler.END
 
     ident = context.args[0]
     # resolve target
     if ident.isdigit():
         target_student = int(ident)
     else:
-        target_student = student_by_ticket(ident) or None
+        target_student = await student_by_ticket(ident) or None
 
     if not target_student:
         await update.message.reply_text("Ученик с таким идентификатором не найден.")
-        return
+        return ConversationHandler.END
 
     # Режим 1: сразу есть текст -> шлём текст немедленно (как раньше)
     if len(context.args) >= 2:
         payload_text = update.message.text.split(maxsplit=2)
         if len(payload_text) < 3:
             await update.message.reply_text("Укажите текст сообщения после идентификатора.")
-            return
+            return ConversationHandler.END
         payload_text = payload_text[2]
 
-        cfg = get_config()
-        reason = violates_policies(payload_text or "", cfg)
+        cfg = await get_config()
+        reason = violates_policies(payload_text or "")
         if reason:
             # Acknowledge to curator (appear delivered) but do NOT forward
             try:
@@ -578,74 +941,69 @@ async def to_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             # record blocked event
             ticket = None
             try:
-                ticket = get_mappings().get("students", {}).get(str(target_student), {}).get("ticket")
+                ticket = (await get_mappings()).get("students", {}).get(target_student, {}).get("ticket")
             except Exception:
                 ticket = None
-            record_blocked_event(sender_id=user_id, sender_username=getattr(update.effective_user, "username", None), direction="/to curator->student", target=target_student, target_ticket=ticket, text=payload_text, reason=reason)
-            return
+            await record_blocked_event(sender_id=user_id, sender_username=getattr(update.effective_user, "username", None), direction="/to curator->student", target=target_student, target_ticket=ticket, text=payload_text, reason=reason)
+            return ConversationHandler.END
 
         await context.bot.send_message(chat_id=target_student, text=payload_text)
         await update.message.reply_text("Доставлено")
-        return
+        return ConversationHandler.END
 
     # Режим 2: без текста -> ждём следующее сообщение (текст или МЕДИА)
     context.user_data["to_target"] = target_student
-    context.user_data["awaiting_to"] = True
     await update.message.reply_text("Ок. Пришлите следующее сообщение (текст/фото/видео/голос/файл) — я отправлю его ученику. Для отмены: /cancel_to")
+    return AWAITING_TO
 
-async def cancel_to_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def cancel_to_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data.pop("to_target", None)
-    context.user_data.pop("awaiting_to", None)
     await update.message.reply_text("Отменено.")
+    return ConversationHandler.END
 
 
-async def to_student_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def to_student_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
     await q.answer()
     data = q.data
     if not data.startswith("to_student:"):
-        return
+        return ConversationHandler.END
     student_id = int(data.split(":", 1)[1])
     # remember selection in user_data and ask for text
     context.user_data["to_target"] = student_id
-    context.user_data["awaiting_to"] = True
     kb = [[InlineKeyboardButton("Отмена", callback_data="to_cancel")]]
     await q.message.reply_text("Напишите текст для отправки выбранному ученику:", reply_markup=InlineKeyboardMarkup(kb))
+    return AWAITING_TO
 
 
-async def to_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def to_cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
     await q.answer()
     context.user_data.pop("to_target", None)
-    context.user_data.pop("awaiting_to", None)
     await q.message.reply_text("Операция отменена.")
+    return ConversationHandler.END
 
 
 async def request_assignment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await q.answer()
     # Notify admins that curator requests assignment
-    cfg = get_config()
-    admins = cfg.get("admins", [])
+    cfg = await get_config()
     user = q.from_user
     note = f"Запрос назначения: куратор id={user.id}"
     if user.username:
         note += f", @{user.username}"
-    for aid in admins:
-        try:
-            await context.application.bot.send_message(aid, note)
-        except Exception:
-            pass
+    await notify_admins(context.application, cfg, note)
     await q.message.reply_text("Админы уведомлены. Ожидайте назначения.")
 
 async def handle_from_student(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    cfg = get_config()
+    cfg = await get_config()
     msg = update.effective_message
     student_id = msg.chat_id
 
     # 1) Policy check on text/caption — if violates, silently drop for user/curator, notify ONLY admins
     text = caption_of(msg)
-    reason = violates_policies(text or "", cfg)
+    reason = violates_policies(text or "")
     if reason:
         # Acknowledge to student (appear delivered) but do NOT forward
         try:
@@ -658,11 +1016,11 @@ async def handle_from_student(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"BLOCKED (student->curator) from {student_id}: {reason}\n{text}"
         )
         # record to blocked.json
-        record_blocked_event(sender_id=student_id, sender_username=getattr(update.effective_user, "username", None), direction="student->curator", target=None, target_ticket=None, text=text, reason=reason)
+        await record_blocked_event(sender_id=student_id, sender_username=getattr(update.effective_user, "username", None), direction="student->curator", target=None, target_ticket=None, text=text, reason=reason)
         return
 
     # 2) Resolve binding (or use default_curator)
-    binding = find_binding(student_id)
+    binding = await find_binding(student_id)
     if not binding:
         default_curator = cfg.get("default_curator")
         if not default_curator:
@@ -671,28 +1029,35 @@ async def handle_from_student(update: Update, context: ContextTypes.DEFAULT_TYPE
                 context.application, cfg,
                 f"NO-DELIVERY (no curator) for student {student_id}. Set default_curator or /link.")
             return
-        binding = set_mapping(student_id, default_curator)
+        binding = await set_mapping(student_id, default_curator)
 
     # 3) Relay to curator, keeping student anonymous
     header = f"Новое сообщение от {binding.ticket}"
 
+    has_media = is_media_copyable_message(msg)
+
     # If it's text-only, send header+text to avoid duplication
-    if text and text.strip() and not is_media_copyable_message(msg):
+    if text and text.strip() and not has_media:
         sent = await context.bot.send_message(binding.curator_id, f"{header}\n——\n{text}")
-        route_remember(sent.message_id, binding.curator_id, student_id)
+        await route_remember(sent.message_id, binding.curator_id, student_id)
         await msg.reply_text("Отправлено куратору ✅")
         return
 
-    # For media (or any message), copy to curator to preserve media without exposing sender
-    copied = await copy_message_safely(update, context, binding.curator_id)
+    cur_id = binding.curator_id
 
-    # Send ticket header separately if media without caption
-    if is_media_copyable_message(msg) and not msg.caption:
-        sent_header = await context.bot.send_message(binding.curator_id, header)
-        route_remember(sent_header.message_id, binding.curator_id, student_id)
+    # For media (or any message), copy to curator to preserve media without exposing sender.
+    # Media without caption also needs a separate ticket header; both requests go out concurrently.
+    if has_media and not msg.caption:
+        copied, sent_header = await asyncio.gather(
+            copy_message_safely(update, context, cur_id),
+            context.bot.send_message(cur_id, header),
+        )
+        await route_remember(sent_header.message_id, cur_id, student_id)
+    else:
+        copied = await copy_message_safely(update, context, cur_id)
 
     # Remember routing for replies
-    route_remember(copied.message_id, binding.curator_id, student_id)
+    await route_remember(copied.message_id, cur_id, student_id)
 
     # Acknowledge to student
     await msg.reply_text("Отправлено куратору ✅")
@@ -701,7 +1066,7 @@ async def handle_from_student(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def mystudents_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """For curators: list your assigned students with tickets."""
     user_id = update.effective_user.id
-    items = list_students_for_curator(user_id)
+    items = await list_students_for_curator(user_id)
     if not items:
         await update.message.reply_text("За вами не закреплено ни одного ученика.")
         return
@@ -711,12 +1076,12 @@ async def mystudents_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def handle_from_curator(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    cfg = get_config()
+    cfg = await get_config()
     msg = update.effective_message
 
     # Check curator message for violations — silently drop and notify ONLY admins
     text = caption_of(msg)
-    reason = violates_policies(text or "", cfg)
+    reason = violates_policies(text or "")
     if reason:
         # Acknowledge to curator (appear delivered) but do NOT forward
         try:
@@ -729,7 +1094,7 @@ async def handle_from_curator(update: Update, context: ContextTypes.DEFAULT_TYPE
             f"BLOCKED (curator->student) from {msg.chat_id}: {reason}\n{text}"
         )
         # record to blocked.json
-        record_blocked_event(sender_id=msg.chat_id, sender_username=getattr(msg.from_user, "username", None), direction="curator->student", target=None, target_ticket=None, text=text, reason=reason)
+        await record_blocked_event(sender_id=msg.chat_id, sender_username=getattr(msg.from_user, "username", None), direction="curator->student", target=None, target_ticket=None, text=text, reason=reason)
         return
 
     # Must be a reply to a bot message that came from a student
@@ -750,86 +1115,86 @@ async def handle_from_curator(update: Update, context: ContextTypes.DEFAULT_TYPE
     await msg.reply_text("Отправлено студенту ✅")
 
 
-# Dispatcher that routes by chat kind: any private chat that's not an admin command
-async def any_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not update.effective_message:
-        return
+class CuratorFilter(filters.MessageFilter):
+    """Messages from users listed under mappings["curators"] (checked against the in-memory cache)."""
+
+    def filter(self, message: Message) -> bool:
+        return message.from_user is not None and message.from_user.id in (_MAP or {}).get("curators", {})
 
-    chat = update.effective_chat
-    if chat.type != ChatType.PRIVATE:
-        return
 
+IS_CURATOR = CuratorFilter(name="IS_CURATOR")
+
+
+# Двухшаговый /to (состояние AWAITING_TO): следующее сообщение любого типа уходит выбранному ученику
+async def to_followup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    mappings = get_mappings()
-    is_maybe_curator = str(user_id) in mappings.get("curators", {})
-
-    # --- НОВОЕ: двухшаговый /to (ожидание следующего сообщения любого типа) ---
-    if is_maybe_curator and context.user_data.get("awaiting_to") and context.user_data.get("to_target"):
-        target_student = context.user_data.get("to_target")
-        msg = update.effective_message
-        cfg = get_config()
-
-        # проверяем политику по тексту/подписи (если есть)
-        txt = caption_of(msg)
-        reason = violates_policies(txt or "", cfg)
-        if reason:
-            # Acknowledge to curator (appear delivered) but do NOT forward
-            try:
-                await update.message.reply_text("Доставлено")
-            except Exception:
-                pass
-            await notify_admins(context.application, cfg, f"BLOCKED (/to curator->student) from {user_id}: {reason}\n{txt or ''}")
-            # record blocked event for awaiting /to
-            ticket = None
-            try:
-                ticket = get_mappings().get("students", {}).get(str(target_student), {}).get("ticket")
-            except Exception:
-                ticket = None
-            record_blocked_event(sender_id=user_id, sender_username=getattr(update.effective_user, "username", None), direction="/to curator->student", target=target_student, target_ticket=ticket, text=txt, reason=reason)
-            # сбрасываем состояние
-            context.user_data.pop("awaiting_to", None)
-            context.user_data.pop("to_target", None)
-            return
+    target_student = context.user_data.get("to_target")
+    msg = update.effective_message
+    cfg = await get_config()
 
+    # проверяем политику по тексту/подписи (если есть)
+    txt = caption_of(msg)
+    reason = violates_policies(txt or "")
+    if reason:
+        # Acknowledge to curator (appear delivered) but do NOT forward
         try:
-            if is_media_copyable_message(msg):
-                # копируем как есть (фото/видео/голос/док/стикер) — сохраняет анонимность
-                await context.bot.copy_message(
-                    chat_id=target_student,
-                    from_chat_id=msg.chat_id,
-                    message_id=msg.message_id,
-                )
-            elif msg.text:
-                await context.bot.send_message(chat_id=target_student, text=msg.text)
-            else:
-                # на всякий случай, если тип не распознан
-                await context.bot.send_message(chat_id=target_student, text="(сообщение куратора)")
             await update.message.reply_text("Доставлено")
         except Exception:
-            await update.message.reply_text("Ошибка при отправке.")
-
+            pass
+        await notify_admins(context.application, cfg, f"BLOCKED (/to curator->student) from {user_id}: {reason}\n{txt or ''}")
+        # record blocked event for awaiting /to
+        ticket = None
+        try:
+            ticket = (await get_mappings()).get("students", {}).get(target_student, {}).get("ticket")
+        except Exception:
+            ticket = None
+        await record_blocked_event(sender_id=user_id, sender_username=getattr(update.effective_user, "username", None), direction="/to curator->student", target=target_student, target_ticket=ticket, text=txt, reason=reason)
         # сбрасываем состояние
-        context.user_data.pop("awaiting_to", None)
         context.user_data.pop("to_target", None)
-        return
-    # --- КОНЕЦ НОВОГО куска ---
+        return ConversationHandler.END
 
-    # далее твоя текущая логика:
-    text = update.effective_message.text if update.effective_message else None
-    if is_maybe_curator and not (text and text.startswith("/")):
-        await handle_from_curator(update, context)
-    else:
-        await handle_from_student(update, context)
+    try:
+        if is_media_copyable_message(msg):
+            # копируем как есть (фото/видео/голос/док/стикер) — сохраняет анонимность
+            await context.bot.copy_message(
+                chat_id=target_student,
+                from_chat_id=msg.chat_id,
+                message_id=msg.message_id,
+            )
+        elif msg.text:
+            await context.bot.send_message(chat_id=target_student, text=msg.text)
+        else:
+            # на всякий случай, если тип не распознан
+            await context.bot.send_message(chat_id=target_student, text="(сообщение куратора)")
+        await update.message.reply_text("Доставлено")
+    except Exception:
+        await update.message.reply_text("Ошибка при отправке.")
+
+    # сбрасываем состояние
+    context.user_data.pop("to_target", None)
+    return ConversationHandler.END
 
 
 # --------------------------- App Bootstrap ---------------------------
 async def post_init(app: Application) -> None:
-    ensure_files()
-    cfg = get_config()
+    await ensure_files()
+    app.bot_data["threads_compactor"] = asyncio.create_task(threads_compactor())
+    if hasattr(signal, "SIGHUP"):  # not available on Windows
+        # Same work as /reload, scheduled right away on the bot's loop
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: app.create_task(reload_data()))
+    cfg = await get_config()
     if cfg.get("admins"):
         await notify_admins(app, cfg, "✅ Bot запущен")
 
 
+async def post_shutdown(app: Application) -> None:
+    task = app.bot_data.pop("threads_compactor", None)
+    if task:
+        task.cancel()
+    await compact_threads()
+    close_seen_db()
+
+
 def build_app() -> Application:
     token = os.environ.get("BOT_TOKEN")
     if not token:
@@ -839,6 +1204,10 @@ def build_app() -> Application:
         ApplicationBuilder()
         .token(token)
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Concurrent updates stay on despite the ConversationHandler below. The only race is a
+        # curator message already in flight before the /to prompt arrives: it is then handled
+        # as a normal curator message (asks to reply to a bot message), never sent to a student.
         .concurrent_updates(True)
         .build()
     )
@@ -846,34 +1215,44 @@ def build_app() -> Application:
     # Commands
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("to", to_cmd))
+    # Two-step /to: the conversation only intercepts messages while AWAITING_TO is active
+    app.add_handler(ConversationHandler(
+        entry_points=[
+            CommandHandler("to", to_cmd),
+            CallbackQueryHandler(to_student_callback, pattern=r"^to_student:\d+$"),
+        ],
+        states={
+            AWAITING_TO: [MessageHandler(filters.ChatType.PRIVATE & ~filters.COMMAND, to_followup)],
+        },
+        fallbacks=[
+            CommandHandler("cancel_to", cancel_to_cmd),
+            CallbackQueryHandler(to_cancel_callback, pattern=r"^to_cancel$"),
+        ],
+        # /to or a student button while AWAITING_TO restarts the flow instead of falling through
+        # to handle_from_student
+        allow_reentry=True,
+    ))
     app.add_handler(CommandHandler("link", link_cmd))
     app.add_handler(CommandHandler("unlink", unlink_cmd))
     app.add_handler(CommandHandler("list", list_cmd))
     app.add_handler(CommandHandler("patterns", patterns_cmd))
     app.add_handler(CommandHandler("setpattern", setpattern_cmd))
     app.add_handler(CommandHandler("delpattern", delpattern_cmd))
-    # Callback handler for selecting student in /to flow
-    app.add_handler(CallbackQueryHandler(to_student_callback, pattern=r"^to_student:\d+$"))
     app.add_handler(CommandHandler("setdefaultcurator", setdefaultcurator_cmd))
+    app.add_handler(CommandHandler("reload", reload_cmd))
     app.add_handler(CommandHandler("mystudents", mystudents_cmd))
     app.add_handler(CommandHandler("cancel_to", cancel_to_cmd))
 
 
-    # Content: everything in private chats
-    content_filter = (
-        filters.ChatType.PRIVATE
-        & (
-            filters.ALL
-        )
-    )
-    app.add_handler(MessageHandler(content_filter, any_message))
+    # Content in private chats, routed by filters (first matching handler in a group wins).
+    # Curators (except for unknown /commands) reply to students; everyone else writes to their curator.
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE & IS_CURATOR & ~filters.COMMAND, handle_from_curator))
+    app.add_handler(MessageHandler(filters.ChatType.PRIVATE, handle_from_student))
 
     return app
 
 
 def main() -> None:
-    ensure_files()
     app = build_app()
     print("Bot is running...")
     app.run_polling(close_loop=False)